@@ -1,9 +1,15 @@
 import os
-import json
+import sys
+import msgspec
+import numpy as np
 import pandas as pd
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
 import glob
-import schedule
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import chain
 import time
 import logging
 
@@ -11,17 +17,187 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# ciso8601 is a much faster ISO parser, but keep plain installs working without it
+try:
+    import ciso8601
+    _parse_iso_datetime = ciso8601.parse_datetime
+except ImportError:
+    _parse_iso_datetime = datetime.fromisoformat
+
+# Same deal for numba - without it the per-metric transform falls back to vectorised NumPy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # === CONFIGURATION ===
 JSON_INPUT_FOLDER = "data/json_files"  # where we keep all the JSON files
 CONSOLIDATED_OUTPUT = "consolidated_table.csv"
 BACKUP_FOLDER = "backups"  # might need this later
+_MS_TO_MIN = 1.0 / 60000.0  # load times come in as milliseconds
+
+# === JSON SCHEMA ===
+# Only the fields we actually read - msgspec skips everything else while decoding
+# Everything is nullable so a null/missing field skips a metric (or the messages), not the whole file
+class MetricDataResult(msgspec.Struct):
+    Id: str | int | None = None
+    Timestamps: list[str] | None = None
+    Values: list[float] | None = None
+
+class CloudWatchPayload(msgspec.Struct):
+    MetricDataResults: list[MetricDataResult] | None = None
+    Messages: list[str] | None = None
+
+# Built once - msgspec specialises the decoder for this exact shape
+_PAYLOAD_DECODER = msgspec.json.Decoder(CloudWatchPayload)
+
+def _has_iso_date_prefix(timestamp_str):
+    """
+    True for strings shaped YYYY-MM-DD, optionally followed by a T or space separator
+    """
+    return (len(timestamp_str) >= 10 and timestamp_str[4] == timestamp_str[7] == "-"
+            and (len(timestamp_str) == 10 or timestamp_str[10] in "T "))
+
+def _parse_runtime_dates(timestamp_list):
+    """
+    Turn ISO timestamp strings into datetime64[D] dates, NaT where a string can't be parsed
+    CloudWatch timestamps look like YYYY-MM-DDTHH:MM:SSZ, so strings with that date prefix are
+    dated from their first 10 chars alone (the time part isn't validated); anything else goes
+    through the full ISO parser. Each string is judged on its own, not on the rest of the file
+    """
+    runtime_dates = np.full(len(timestamp_list), np.datetime64("NaT"), dtype="datetime64[D]")
+    
+    dated_positions, date_strings = [], []
+    for position, timestamp_str in enumerate(timestamp_list):
+        if _has_iso_date_prefix(timestamp_str):
+            dated_positions.append(position)
+            date_strings.append(timestamp_str[:10])
+            continue
+        # Not a plain YYYY-MM-DD prefix (e.g. basic format or junk) - full parse
+        try:
+            runtime_dates[position] = np.datetime64(_parse_iso_datetime(timestamp_str).date(), "D")
+        except ValueError:
+            pass
+    
+    try:
+        runtime_dates[dated_positions] = np.array(date_strings, dtype="datetime64[D]")
+    except ValueError:
+        # An impossible date (e.g. 2024-13-45) somewhere - go one by one so it only costs its own row
+        for position, date_str in zip(dated_positions, date_strings):
+            try:
+                runtime_dates[position] = np.datetime64(date_str, "D")
+            except ValueError:
+                pass
+    return runtime_dates
+
+def _expand_metric_rows_loop(values_flat, values_off, rows_off, out_load, out_metric):
+    """
+    Per-metric transform over CSR-style arrays, compiled with numba when it's installed:
+    metric m owns values_flat[values_off[m]:values_off[m + 1]] and output rows rows_off[m]:rows_off[m + 1].
+    Writes the metric's average load time (in minutes) and its index into every one of its rows
+    """
+    for metric in range(len(values_off) - 1):
+        value_start = values_off[metric]
+        value_end = values_off[metric + 1]
+        total_load_time = 0.0
+        for position in range(value_start, value_end):
+            total_load_time += values_flat[position]
+        average_load_minutes = total_load_time / (value_end - value_start) * _MS_TO_MIN
+        
+        for row in range(rows_off[metric], rows_off[metric + 1]):
+            out_load[row] = average_load_minutes
+            out_metric[row] = metric
+
+def _expand_metric_rows_numpy(values_flat, values_off, rows_off, out_load, out_metric):
+    """
+    Same transform as _expand_metric_rows_loop, vectorised with NumPy for installs without numba
+    Every metric has at least one value, so reduceat's offsets are strictly increasing
+    """
+    row_counts = np.diff(rows_off)
+    average_load_minutes = np.add.reduceat(values_flat, values_off[:-1]) / np.diff(values_off) * _MS_TO_MIN
+    out_load[:] = np.repeat(average_load_minutes, row_counts)
+    out_metric[:] = np.repeat(np.arange(len(row_counts)), row_counts)
+
+# The element-by-element loop only pays off once compiled - plain Python would be slower than NumPy
+_expand_metric_rows = njit(cache=True)(_expand_metric_rows_loop) if njit else _expand_metric_rows_numpy
+
+def _process_one(json_file_path):
+    """
+    Process a single JSON file into column arrays (ids, runtime_dates, load_times, messages)
+    Runs inside a worker process, returns None if the file couldn't be processed
+    """
+    try:
+        logger.info(f"Processing file: {os.path.basename(json_file_path)}")
+        
+        # Read in the worker itself so the bytes never get pickled across from the parent
+        # Raw unbuffered bytes - msgspec validates UTF-8 itself, no extra copy through a buffer
+        with open(json_file_path, "rb", buffering=0) as file:
+            if hasattr(os, "posix_fadvise"):  # Linux only - hint the kernel to read ahead
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            file_buffer = file.read()
+        
+        payload = _PAYLOAD_DECODER.decode(file_buffer)
+        
+        # Messages are file-scoped, so join them once rather than per metric
+        joined_message = "; ".join(payload.Messages) if payload.Messages else None
+        
+        # Gather the usable metrics - the numeric work happens in one array pass below
+        metric_ids, timestamps, value_lists, row_counts = [], [], [], []
+        for metric_item in payload.MetricDataResults or []:
+            # Skip if we don't have both timestamps and values
+            if not metric_item.Timestamps or not metric_item.Values:
+                logger.warning(f"Skipping metric {metric_item.Id} - missing data")
+                continue
+            
+            metric_ids.append(metric_item.Id)
+            timestamps.extend(metric_item.Timestamps)
+            value_lists.append(metric_item.Values)
+            row_counts.append(len(metric_item.Timestamps))
+        
+        if not metric_ids:
+            return [], [], [], []
+        
+        # Flatten into CSR-style arrays: offsets mark where each metric's values / rows start
+        values_off = np.zeros(len(value_lists) + 1, dtype=np.int64)
+        np.cumsum([len(value_list) for value_list in value_lists], out=values_off[1:])
+        rows_off = np.zeros(len(row_counts) + 1, dtype=np.int64)
+        np.cumsum(row_counts, out=rows_off[1:])
+        values_flat = np.fromiter(chain.from_iterable(value_lists), dtype=np.float64, count=values_off[-1])
+        
+        # One row per timestamp - the kernel fills load times and metric codes for every row
+        load_times = np.empty(rows_off[-1], dtype=np.float64)
+        metric_codes = np.empty(rows_off[-1], dtype=np.int64)
+        _expand_metric_rows(values_flat, values_off, rows_off, load_times, metric_codes)
+        
+        # Reattach the string ids from their integer codes
+        ids = np.array(metric_ids, dtype=object)[metric_codes]
+        messages = np.full(len(load_times), joined_message, dtype=object)
+        
+        # Dates are parsed here in the worker, once per file
+        runtime_dates = _parse_runtime_dates(timestamps)
+        valid_mask = ~np.isnat(runtime_dates)
+        for bad_timestamp in np.asarray(timestamps, dtype=object)[~valid_mask]:
+            logger.error(f"Could not parse timestamp {bad_timestamp}")
+        
+        # One array per column keeps pickling back to the parent cheap
+        return ids[valid_mask], runtime_dates[valid_mask], load_times[valid_mask], messages[valid_mask]
+        
+    except msgspec.DecodeError as json_error:
+        logger.error(f"Failed to parse JSON file {json_file_path}: {json_error}")
+    except Exception as general_error:
+        logger.error(f"Unexpected error processing {json_file_path}: {general_error}")
+    return None
 
 def process_all_json_files():
     """
     Main function to process JSON files and create consolidated table
-    TODO: maybe add error handling for corrupted JSON files?
+    Files are read and parsed across a process pool
     """
-    records_list = []
+    # Columnar accumulators - one array chunk per file instead of a dict per row
+    id_chunks = []
+    date_chunks = []
+    load_time_chunks = []
+    message_chunks = []
     processed_files = 0
     
     logger.info(f"Starting to process JSON files from {JSON_INPUT_FOLDER}")
@@ -34,74 +210,54 @@ def process_all_json_files():
         logger.warning("No JSON files found in the input directory!")
         return
     
-    # Process each file
-    for json_file_path in json_files:
-        try:
-            logger.info(f"Processing file: {os.path.basename(json_file_path)}")
-            
-            with open(json_file_path, "r", encoding='utf-8') as file:
-                file_data = json.load(file)
-            
-            # Extract the metric data - structure seems consistent across files
-            metric_data_results = file_data.get("MetricDataResults", [])
-            message_list = file_data.get("Messages", [])
-            
-            # Process each metric
-            for metric_item in metric_data_results:
-                metric_identifier = metric_item.get("Id")
-                timestamp_list = metric_item.get("Timestamps", [])
-                value_list = metric_item.get("Values", [])
-                
-                # Skip if we don't have both timestamps and values
-                if not timestamp_list or not value_list:
-                    logger.warning(f"Skipping metric {metric_identifier} - missing data")
-                    continue
-                
-                # Convert load time from milliseconds to minutes
-                # Note: dividing by 60000 because that's ms -> minutes conversion
-                total_load_time = sum(value_list)
-                average_load_minutes = total_load_time / len(value_list) / 60000.0
-                
-                # Create a record for each timestamp
-                for timestamp_str in timestamp_list:
-                    try:
-                        # Parse the ISO format timestamp
-                        parsed_date = datetime.fromisoformat(timestamp_str).date()
-                        
-                        data_record = {
-                            "id": metric_identifier,
-                            "runtime_date": parsed_date,
-                            "load_time": average_load_minutes,
-                            "message": "; ".join(message_list) if message_list else None
-                        }
-                        records_list.append(data_record)
-                        
-                    except ValueError as date_error:
-                        logger.error(f"Could not parse timestamp {timestamp_str}: {date_error}")
-                        continue
-            
+    # Process files in parallel - each worker reads and parses its own files,
+    # chunksize amortises the pickling round-trips
+    with ProcessPoolExecutor() as executor:
+        for file_result in executor.map(_process_one, json_files, chunksize=8):
+            if file_result is None:
+                continue
+            file_ids, file_dates, file_load_times, file_messages = file_result
+            if len(file_ids):
+                id_chunks.append(file_ids)
+                date_chunks.append(file_dates)
+                load_time_chunks.append(file_load_times)
+                message_chunks.append(file_messages)
             processed_files += 1
-            
-        except json.JSONDecodeError as json_error:
-            logger.error(f"Failed to parse JSON file {json_file_path}: {json_error}")
-            continue
-        except Exception as general_error:
-            logger.error(f"Unexpected error processing {json_file_path}: {general_error}")
-            continue
     
-    if not records_list:
+    if not id_chunks:
         logger.warning("No records were extracted from the JSON files")
         return
     
-    # Create DataFrame and save to CSV
-    consolidated_df = pd.DataFrame(records_list)
+    id_array = np.concatenate(id_chunks)
+    date_array = np.concatenate(date_chunks)
+    
+    # Sort by date then id with a single argsort over packed uint64 keys:
+    # high 32 bits = days since the earliest date, low 32 bits = id category code
+    # (categories come out sorted, so code order == id order; missing ids sort last)
+    id_categories = pd.Categorical(id_array)
+    id_codes = np.where(id_categories.codes < 0, len(id_categories.categories), id_categories.codes)
+    day_numbers = date_array.astype("int64")
+    sort_keys = ((day_numbers - day_numbers.min()).astype("uint64") << np.uint64(32)) | id_codes.astype("uint64")
+    row_order = np.argsort(sort_keys, kind="stable")
     
-    # Sort by date for better readability
-    consolidated_df = consolidated_df.sort_values(['runtime_date', 'id'])
+    # Create DataFrame from pre-typed columns so pandas doesn't have to infer per row
+    consolidated_df = pd.DataFrame({
+        "id": id_array[row_order],
+        "runtime_date": date_array[row_order],
+        "load_time": np.concatenate(load_time_chunks)[row_order],
+        "message": np.concatenate(message_chunks)[row_order]
+    })
     
     try:
-        consolidated_df.to_csv(CONSOLIDATED_OUTPUT, index=False)
-        logger.info(f"Successfully saved {len(records_list)} records to {CONSOLIDATED_OUTPUT}")
+        # Arrow's multithreaded C++ writer instead of pandas' Python-level formatting
+        output_table = pa.Table.from_pandas(consolidated_df, preserve_index=False)
+        date_column = output_table.schema.get_field_index("runtime_date")
+        output_table = output_table.set_column(
+            date_column, "runtime_date", pc.cast(output_table["runtime_date"], pa.date32())
+        )  # write plain dates, not midnight timestamps
+        pacsv.write_csv(output_table, CONSOLIDATED_OUTPUT,
+                        write_options=pacsv.WriteOptions(include_header=True))
+        logger.info(f"Successfully saved {len(consolidated_df)} records to {CONSOLIDATED_OUTPUT}")
         logger.info(f"Processed {processed_files} JSON files")
     except Exception as save_error:
         logger.error(f"Failed to save CSV file: {save_error}")
@@ -124,6 +280,7 @@ def run_monthly_etl():
     except Exception as etl_error:
         logger.error(f"Monthly ETL failed: {etl_error}")
         # Could add email notification here later
+        raise
 
 def create_backup_folder():
     """
@@ -135,14 +292,14 @@ def create_backup_folder():
         logger.info(f"Created backup folder: {BACKUP_FOLDER}")
 
 # === JOB SCHEDULING ===
-# Run on the 1st of every month at 00:05 (avoiding midnight exactly)
-schedule.every().month.at("00:05").do(run_monthly_etl)
+# Scheduling is left to systemd (see systemd/bonus-etl-cleanse-json.timer), which runs
+# this script on the 1st of every month at 00:05 - no need to keep a process idling all month
 
 def main():
     """
-    Main entry point - starts the scheduler
+    Main entry point - runs the monthly ETL once and exits
     """
-    logger.info("JSON ETL Scheduler is starting up...")
+    logger.info("JSON ETL job is starting up...")
     
     # Create necessary directories
     create_backup_folder()
@@ -150,20 +307,13 @@ def main():
     # Make sure input directory exists
     if not os.path.exists(JSON_INPUT_FOLDER):
         logger.error(f"Input directory {JSON_INPUT_FOLDER} does not exist!")
-        return
-    
-    logger.info("Scheduler is now waiting for the monthly trigger (1st day at 00:05)")
-    logger.info("Press Ctrl+C to stop the scheduler")
+        sys.exit(1)
     
+    # Exit non-zero on failure so systemd records the run as failed
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(60)  # Check every minute - not too aggressive
-            
-    except KeyboardInterrupt:
-        logger.info("Scheduler stopped by user")
-    except Exception as scheduler_error:
-        logger.error(f"Scheduler error: {scheduler_error}")
+        run_monthly_etl()
+    except Exception:
+        sys.exit(1)  # already logged in run_monthly_etl
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
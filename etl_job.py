@@ -1,10 +1,15 @@
 import os
 import psycopg2
 import clickhouse_connect
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
 from dotenv import load_dotenv
 import logging
 import json
+from datetime import datetime, timezone
 from pathlib import Path
+import tempfile
 import time
 
 # Load env vars first thing
@@ -18,8 +23,24 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Constants - to makesure checkpoint load data based on datetime
-WATERMARK_FILE = "etl_watermark.json"
+ETL_STATE_NAME = "retail_transaction"  # key of this pipeline's row in etl_state
+LEGACY_WATERMARK_FILE = "etl_watermark.json"  # old file checkpoint, only read to seed etl_state
 DEFAULT_BATCH_SIZE = 5000  # Found this works well in practice
+APPROX_ROW_BYTES = 128  # rough CSV width of one row, used to size Arrow read blocks
+
+# Arrow schema for retail_transaction - defined up front so Arrow never has to infer types
+# Timestamps are naive UTC: the source columns are assumed to be TIMESTAMP (without time zone),
+# and fetch_postgres_data casts them to that in a UTC session so TIMESTAMPTZ sources work too
+RETAIL_TRANSACTION_SCHEMA = pa.schema([
+    ("id", pa.uint64()),
+    ("customer_id", pa.uint64()),
+    ("last_status", pa.string()),
+    ("pos_origin", pa.string()),
+    ("pos_destination", pa.string()),
+    ("created_at", pa.timestamp("us")),
+    ("updated_at", pa.timestamp("us")),
+    ("deleted_at", pa.timestamp("us")),
+])
 
 def connect_to_postgres():
     """
@@ -87,93 +108,159 @@ def setup_clickhouse_table(clickhouse_client):
         logger.error(f"Failed to create ClickHouse table: {e}")
         raise
 
-def fetch_postgres_data(postgres_conn,last_watermark=None, batch_size=DEFAULT_BATCH_SIZE):
+def fetch_postgres_data(postgres_conn,last_watermark=None):
     """
-    Extract data from PostgreSQL in batches
-    use server-side cursor to avoid loading everything into memory
+    Extract data from PostgreSQL into a spooled temp file of CSV
+    COPY ... TO STDOUT ships the result in one round-trip. Runs in the caller's
+    transaction and doesn't commit; the caller owns the returned file and closes it
     """
-    cursor = postgres_conn.cursor(name="etl_cursor")  # server-side cursor
-    cursor.itersize = batch_size
+    cursor = postgres_conn.cursor()
+    
+    # Arrow's CSV reader rejects zone offsets like "+07" in a naive timestamp column, so
+    # the SELECT casts to plain timestamp - in UTC for this transaction only, which also
+    # makes the naive watermark compare as UTC against TIMESTAMPTZ sources
+    cursor.execute("SET LOCAL TIME ZONE 'UTC'")
     
     if last_watermark:
-        cursor.execute("""
+        # COPY can't take bind params, so let psycopg2 quote the watermark for us
+        select_query = cursor.mogrify("""
             SELECT id, customer_id, last_status, pos_origin, pos_destination,
-                   created_at, updated_at, deleted_at
+                   created_at::timestamp, updated_at::timestamp, deleted_at::timestamp
             FROM retail_transaction
             WHERE updated_at > %s and deleted_at IS NOT NULL
-            ORDER BY updated_at;
-        """, (last_watermark,))
+            ORDER BY updated_at
+        """, (last_watermark,)).decode()
     else:
         # First full load
-        cursor.execute("""
+        select_query = """
             SELECT id, customer_id, last_status, pos_origin, pos_destination,
-                   created_at, updated_at, deleted_at
+                   created_at::timestamp, updated_at::timestamp, deleted_at::timestamp
             FROM retail_transaction
             WHERE deleted_at IS NOT NULL
-            ORDER BY updated_at;
-        """)
+            ORDER BY updated_at
+        """
     
-    while True:
-        rows = cursor.fetchmany(batch_size)
-        if not rows:
-            break
-        yield rows
-    
-    cursor.close()
+    # Spool the COPY output to a temp file (spills to disk, not memory)
+    copy_buffer = tempfile.TemporaryFile()
+    try:
+        cursor.copy_expert(f"COPY ({select_query}) TO STDOUT WITH (FORMAT CSV)", copy_buffer)
+    except Exception:
+        copy_buffer.close()
+        raise
+    finally:
+        cursor.close()
+    copy_buffer.seek(0)
+    return copy_buffer
 
-def insert_to_clickhouse(ch_client, data_rows):
+def read_postgres_batches(copy_buffer, batch_size=DEFAULT_BATCH_SIZE):
     """
-    Load batch of data into ClickHouse
+    Read the spooled COPY output back as Arrow record batches
+    Arrow's CSV reader parses it in C++, so rows never become Python tuples
     """
-    if not data_rows:
+    batch_reader = pacsv.open_csv(
+        copy_buffer,
+        read_options=pacsv.ReadOptions(
+            column_names=RETAIL_TRANSACTION_SCHEMA.names,
+            block_size=batch_size * APPROX_ROW_BYTES,
+        ),
+        # COPY quotes text values containing newlines - without this Arrow's chunker
+        # splits such a row across blocks and the read fails
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(column_types=RETAIL_TRANSACTION_SCHEMA),
+    )
+    for record_batch in batch_reader:
+        if record_batch.num_rows:
+            yield record_batch
+
+def insert_to_clickhouse(ch_client, data_batch):
+    """
+    Load an Arrow record batch into ClickHouse
+    """
+    if not data_batch.num_rows:
         logger.warning("No data to insert")
         return
     
     try:
-        ch_client.insert(
-            "retail_transaction",
-            data_rows,
-            column_names=[
-                "id",
-                "customer_id", 
-                "last_status",
-                "pos_origin",
-                "pos_destination",
-                "created_at",
-                "updated_at",
-                "deleted_at"
-            ]
-        )
-        logger.info(f"Successfully inserted {len(data_rows)} rows")
+        # Columnar buffers go over the wire as-is via insert_arrow
+        ch_client.insert_arrow("retail_transaction", pa.Table.from_batches([data_batch]))
+        logger.info(f"Successfully inserted {data_batch.num_rows} rows")
     except Exception as insert_error:
         logger.error(f"Insert operation failed: {insert_error}")
         raise
 
-def load_last_watermark():
+def setup_etl_state_table(postgres_conn):
     """
-    Read the last processed timestamp from watermark file
-    Returns None if file doesn't exist yet
+    Create the etl_state table if it doesn't exist
+    Keeps the watermark next to the source data instead of in a local file
     """
-    watermark_path = Path(WATERMARK_FILE)
+    try:
+        with postgres_conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS etl_state (
+                    name TEXT PRIMARY KEY,
+                    ts TIMESTAMP
+                )
+            """)
+        postgres_conn.commit()
+        logger.info("PostgreSQL etl_state table setup completed")
+    except psycopg2.Error as e:
+        logger.error(f"Failed to create etl_state table: {e}")
+        raise
+
+def load_legacy_watermark():
+    """
+    Read the watermark left behind by the old etl_watermark.json checkpoint, as naive UTC
+    Returns None if the file doesn't exist or can't be read
+    """
+    watermark_path = Path(LEGACY_WATERMARK_FILE)
     if watermark_path.exists():
         try:
             with open(watermark_path, "r") as file:
                 watermark_data = json.load(file)
-                return watermark_data.get("last_updated_at")
-        except (json.JSONDecodeError, IOError) as e:
-            logger.warning(f"Could not read watermark file: {e}")
+            timestamp_value = watermark_data.get("last_updated_at")
+            if not timestamp_value:
+                return None
+            legacy_watermark = datetime.fromisoformat(timestamp_value)
+            # TIMESTAMPTZ sources left aware values like "2025-09-19 11:30:00+07:00" -
+            # normalise to naive UTC, which is what the extract compares and stores now
+            if legacy_watermark.tzinfo is not None:
+                legacy_watermark = legacy_watermark.astimezone(timezone.utc).replace(tzinfo=None)
+            return legacy_watermark
+        except (json.JSONDecodeError, IOError, ValueError) as e:
+            logger.warning(f"Could not read legacy watermark file: {e}")
     return None
 
-def save_current_watermark(timestamp_value):
+def load_last_watermark(postgres_conn):
     """
-    Save the current watermark to file for next run
+    Read the last processed timestamp from etl_state
+    If there's no row yet, seed it from the legacy watermark file so existing
+    deployments don't fall back to a full reload. Returns None if neither exists
     """
-    try:
-        with open(WATERMARK_FILE, "w") as file:
-            json.dump({"last_updated_at": timestamp_value}, file, indent=2)
-        logger.info(f"Watermark saved: {timestamp_value}")
-    except IOError as e:
-        logger.error(f"Failed to save watermark: {e}")
+    with postgres_conn.cursor() as cursor:
+        cursor.execute("SELECT ts FROM etl_state WHERE name = %s", (ETL_STATE_NAME,))
+        state_row = cursor.fetchone()
+    if state_row:
+        return state_row[0]
+    
+    legacy_watermark = load_legacy_watermark()
+    if legacy_watermark:
+        with postgres_conn.cursor() as cursor:
+            # Same UTC session setting the extract uses, so the seed is read back unshifted
+            cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+        save_current_watermark(postgres_conn, legacy_watermark)
+        logger.info(f"Seeded etl_state from {LEGACY_WATERMARK_FILE}: {legacy_watermark}")
+    return legacy_watermark
+
+def save_current_watermark(postgres_conn, timestamp_value):
+    """
+    Upsert the current watermark into etl_state
+    Doesn't commit - that's up to the caller
+    """
+    with postgres_conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO etl_state (name, ts) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET ts = EXCLUDED.ts
+        """, (ETL_STATE_NAME, timestamp_value))
 
 def execute_etl_pipeline():
     """
@@ -188,45 +275,41 @@ def execute_etl_pipeline():
     try:
         logger.info("Starting ETL pipeline...")
 
-        # Load last watermark
-        last_watermark = load_last_watermark()
-        logger.info(f"Loaded last watermark: {last_watermark}")
-
         # Initialize connections
         pg_connection = connect_to_postgres()
         ch_client = connect_to_clickhouse()
         
-        # Setup destination table
+        # Setup state and destination tables
+        setup_etl_state_table(pg_connection)
         setup_clickhouse_table(ch_client)
+
+        # Load last watermark (seeding etl_state on first run) and extract in one transaction
+        last_watermark = load_last_watermark(pg_connection)
+        logger.info(f"Loaded last watermark: {last_watermark}")
         
-        # Process data in batches
-        batch_buffer = []
         total_processed = 0
         current_watermark = last_watermark  # track latest timestamp
 
-        for batch_data in fetch_postgres_data(pg_connection, last_watermark, DEFAULT_BATCH_SIZE):
-            batch_buffer.extend(batch_data)
-            
-            # Update watermark candidate (max updated_at in this batch)
-            batch_max_ts = max(row[6] for row in batch_data if row[6])  # row[6] = updated_at
-            if not current_watermark or batch_max_ts > current_watermark:
-                current_watermark = batch_max_ts
+        with fetch_postgres_data(pg_connection, last_watermark) as copy_buffer:
+            # The extract is spooled locally now - commit it (and any watermark seed) so the
+            # transaction doesn't sit idle, holding its snapshot, for the whole ClickHouse load
+            pg_connection.commit()
             
-            # Process when we have enough data
-            if len(batch_buffer) >= DEFAULT_BATCH_SIZE:
-                insert_to_clickhouse(ch_client, batch_buffer)
-                total_processed += len(batch_buffer)
-                batch_buffer = []  # Reset for next batch
-        
-        # Handle remaining data
-        if batch_buffer:
-            insert_to_clickhouse(ch_client, batch_buffer)
-            total_processed += len(batch_buffer)
+            # Stream each batch straight into ClickHouse - no second buffer
+            for batch_data in read_postgres_batches(copy_buffer, DEFAULT_BATCH_SIZE):
+                insert_to_clickhouse(ch_client, batch_data)
+                total_processed += batch_data.num_rows
+                
+                # Max updated_at in this batch - pc.max skips NULLs, which Postgres sorts last
+                batch_max_ts = pc.max(batch_data["updated_at"]).as_py()
+                if batch_max_ts and (not current_watermark or batch_max_ts > current_watermark):
+                    current_watermark = batch_max_ts
         
-        # Save new watermark if updated
+        # Save new watermark if updated - only after every batch made it into ClickHouse
         if current_watermark:
-            save_current_watermark(str(current_watermark))  # serialize datetime
-            logger.info(f"Updated watermark saved: {current_watermark}")
+            save_current_watermark(pg_connection, current_watermark)
+        pg_connection.commit()
+        logger.info(f"Watermark committed: {current_watermark}")
 
         elapsed_time = time.time() - start_time
         logger.info(f"ETL completed! Processed {total_processed} records in {elapsed_time:.2f} seconds")